@@ -1,10 +1,16 @@
 import struct 
-import json 
 import codecs
 import io
+import os
+import sys
 from collections import OrderedDict
 BTKFILEMAGIC = b"J3D1btk1"
 PADDING = b"This is padding data to align"
+DUMP_CHUNK_SIZE = 64*1024
+MAX_ANGLESCALE = 15
+TRACK_NAMES = ("scale_u", "scale_v", "scale_w",
+               "rotation_u", "rotation_v", "rotation_w",
+               "translation_u", "translation_v", "translation_w")
 
 def read_uint32(f):
     return struct.unpack(">I", f.read(4))[0]
@@ -49,39 +55,38 @@ def opt_round(val, digits):
     else:
         return round(val, digits)
 
-def write_indented(f, text, level):
-    f.write(" "*level)
-    f.write(text)
-    f.write("\n")
+# Size of one step of the sint16 rotation values in degrees
+def rotation_scale(anglescale):
+    return (2.0**anglescale)*(180.0 / 32768.0)
+
+# Rounds a rotation in degrees to the nearest step that can be stored.
+def quantize_rotation(val, rotscale):
+    quantized = int(round(val/rotscale))
+    if not -0x8000 <= quantized <= 0x7FFF:
+        raise RuntimeError("Rotation value {} is out of range for a step size of {}".format(val, rotscale))
+    return quantized
 
 # Find the start of the sequence seq in the list in_list, if the sequence exists
 def find_sequence(in_list, seq):
-    matchup = 0
-    start = -1
-
-    found = False
-    started = False
-
-    for i, val in enumerate(in_list):
-        if val == seq[matchup]:
-            if not started:
-                start = i
-                started = True
-
-            matchup += 1
-            if matchup == len(seq):
-                #start = i-matchup
-                found = True
-                break
-        else:
-            matchup = 0
-            start = -1
-            started = False
-    if not found:
-        start = -1
+    length = len(seq)
+    if length == 0:
+        return 0
+
+    last_start = len(in_list) - length
+    start = 0
+
+    while start <= last_start:
+        # Jump to the next place where the first value matches
+        try:
+            start = in_list.index(seq[0], start, last_start+1)
+        except ValueError:
+            return -1
 
+        if in_list[start:start+length] == seq:
+            return start
+        start += 1
 
-    return start
+    return -1
 
 def find_single_value(in_list, value):
     
@@ -222,14 +227,22 @@ class MatrixAnimation(object):
         self._rot_offsets = {}
         self._translation_offsets = {}
 
+        # Entry of the key table in the btk this animation was read from. As long as
+        # the tracks aren't changed, it still points to the right place in the key
+        # pools of that btk.
+        self._key_table = None
+
     def add_scale(self, axis, comp):
         self.scale[axis].append(comp)
+        self._key_table = None
     
     def add_rotation(self, axis, comp):
         self.rotation[axis].append(comp)
+        self._key_table = None
         
     def add_translation(self, axis, comp):
         self.translation[axis].append(comp)
+        self._key_table = None
 
     # These functions are used for keeping track of the offset
     # in the json->btk conversion and are otherwise not useful.
@@ -242,6 +255,41 @@ class MatrixAnimation(object):
     def _set_translation_offsets(self, axis, val):
         self._translation_offsets[axis] = val
 
+    # Tracks are addressed by the same names that are used in the json format,
+    # e.g. "rotation_w".
+    def get_track(self, trackname):
+        kind, axis = trackname.split("_")
+        return getattr(self, kind)[axis.upper()]
+
+    def set_track(self, trackname, comps):
+        kind, axis = trackname.split("_")
+        getattr(self, kind)[axis.upper()] = comps
+        self._key_table = None
+
+    def serialize(self):
+        data = OrderedDict()
+        data["material_name"] = self.name
+        data["material_texture_index"] = self.matindex
+        data["center"] = list(self.center)
+
+        for trackname in TRACK_NAMES:
+            data[trackname] = [comp.serialize() for comp in self.get_track(trackname)]
+
+        return data
+
+    @classmethod
+    def from_dict(cls, index, animation):
+        matanim = cls(
+            index,
+            animation["material_texture_index"],
+            animation["material_name"],
+            animation["center"])
+
+        for trackname in TRACK_NAMES:
+            matanim.set_track(trackname, [AnimComponent(*comp) for comp in animation[trackname]])
+
+        return matanim
+
 
 class BTKAnim(object):
     def __init__(self, loop_mode, anglescale, duration, unknown_address=0):
@@ -250,156 +298,145 @@ class BTKAnim(object):
         self.anglescale = anglescale
         self.duration = duration
         self.unknown_address = unknown_address
-    
-    def dump(self, f, digits=None):
-        write_indented(f, "{", level=0)
 
-        write_indented(f, "\"loop_mode\": {},".format(self.loop_mode), level=4)
-        write_indented(f, "\"angle_scale\": {},".format(self.anglescale), level=4)
-        write_indented(f, "\"duration\": {},".format(self.duration), level=4)
-        write_indented(f, "\"unknown\": \"0x{:x}\",".format(self.unknown_address), level=4)
-        write_indented(f, "", level=4)
-        write_indented(f, "\"animations\": [", level=4)
+        # Scale, rotation and translation pools of the btk this was read from
+        self._pools = None
+    
+    # Yields the json text of the animation in pieces of roughly chunk_size characters,
+    # so it can be written or sent somewhere without building the whole text first.
+    def iter_json_chunks(self, digits=None, chunk_size=DUMP_CHUNK_SIZE):
+        lines = []
+        size = 0
+
+        for line in self._iter_json_lines(digits):
+            lines.append(line)
+            size += len(line)
+
+            if size >= chunk_size:
+                yield "".join(lines)
+                lines = []
+                size = 0
+
+        if lines:
+            yield "".join(lines)
+
+    def _iter_json_lines(self, digits):
+        yield "{\n"
+        yield "    \"loop_mode\": {},\n".format(self.loop_mode)
+        yield "    \"angle_scale\": {},\n".format(self.anglescale)
+        yield "    \"duration\": {},\n".format(self.duration)
+        yield "    \"unknown\": \"0x{:x}\",\n".format(self.unknown_address)
+        yield "    \n"
+        yield "    \"animations\": [\n"
 
         anim_count = len(self.animations)
         for i, animation in enumerate(self.animations):
-            write_indented(f, "{", level=8)
-
-            write_indented(f, "\"material_name\": \"{}\",".format(animation.name), level=12)
-            write_indented(f, "\"material_texture_index\": {},".format(animation.matindex), level=12)
-            write_indented(f,
-                           "\"center\": [{}, {}, {}],".format(
-                               *(opt_round(x, digits) for x in animation.center)),
-                           level=12)
-
-            write_indented(f, "", level=12)
-
-            for axis in "UVW":
-                write_indented(f, "\"scale_{}\": [".format(axis.lower()), level=12)
-                trans_count = len(animation.scale[axis])
-                for j, comp in enumerate(animation.scale[axis]):
-                    if j < trans_count-1:
-                        write_indented(f,
-                                       "[{}, {}, {}, {}],".format(
-                                           *(opt_round(x, digits) for x in comp.serialize())),
-                                       level=16)
+            yield "        {\n"
+            yield "            \"material_name\": \"{}\",\n".format(animation.name)
+            yield "            \"material_texture_index\": {},\n".format(animation.matindex)
+            yield "            \"center\": [{}, {}, {}],\n".format(
+                *(opt_round(x, digits) for x in animation.center))
+            yield "            \n"
+
+            for trackname in TRACK_NAMES:
+                yield "            \"{}\": [\n".format(trackname)
+                track = animation.get_track(trackname)
+                comp_count = len(track)
+                for j, comp in enumerate(track):
+                    line = "                [{}, {}, {}, {}]".format(*(opt_round(x, digits) for x in comp.serialize()))
+                    if j < comp_count-1:
+                        yield line + ",\n"
                     else:
-                        write_indented(f,
-                                       "[{}, {}, {}, {}]".format(
-                                           *(opt_round(x, digits) for x in comp.serialize())),
-                                       level=16)
-                                       
-                write_indented(f, "],", level=12)
-            
-            for axis in "UVW":
-                write_indented(f, "\"rotation_{}\": [".format(axis.lower()), level=12)
-                trans_count = len(animation.rotation[axis])
-                for j, comp in enumerate(animation.rotation[axis]):
-                    if j < trans_count-1:
-                        write_indented(f,
-                                       "[{}, {}, {}, {}],".format(
-                                           *(opt_round(x, digits) for x in comp.serialize())),
-                                       level=16)
-                    else:
-                        write_indented(f,
-                                       "[{}, {}, {}, {}]".format(
-                                           *(opt_round(x, digits) for x in comp.serialize())),
-                                       level=16)
-               
-                write_indented(f, "],", level=12)
+                        yield line + "\n"
 
-            for axis in "UVW":
-                write_indented(f, "\"translation_{}\": [".format(axis.lower()), level=12)
-                trans_count = len(animation.translation[axis])
-                for j, comp in enumerate(animation.translation[axis]):
-                    if j < trans_count-1:
-                        write_indented(f,
-                                       "[{}, {}, {}, {}],".format(
-                                           *(opt_round(x, digits) for x in comp.serialize())),
-                                       level=16)
-                    else:
-                        write_indented(f,
-                                       "[{}, {}, {}, {}]".format(
-                                           *(opt_round(x, digits) for x in comp.serialize())),
-                                       level=16)
-                if axis != "W":
-                    write_indented(f, "],", level=12)
+                if trackname != TRACK_NAMES[-1]:
+                    yield "            ],\n"
                 else:
-                    write_indented(f, "]", level=12)
+                    yield "            ]\n"
 
             if i < anim_count-1:
-                write_indented(f, "},", level=8)
+                yield "        },\n"
             else:
-                write_indented(f, "}", level=8)
-
-        write_indented(f, "]", level=4)
-        write_indented(f, "}", level=0)
-
-    def write_btk(self, f):
-        f.write(BTKFILEMAGIC)
-        filesize_offset = f.tell()
-        f.write(b"ABCD") # Placeholder for file size
-        write_uint32(f, 1) # Always a section count of 1
-        f.write(b"SVR1" + b"\xFF"*12)
-
-        ttk1_start = f.tell()
-        f.write(b"TTK1")
-
-        ttk1_size_offset = f.tell()
-        f.write(b"EFGH")  # Placeholder for ttk1 size
-        write_uint8(f, self.loop_mode)
-        write_sint8(f, self.anglescale)
-        
-        rotscale = (2.0**self.anglescale)*(180.0 / 32768.0)
-        
-        write_uint16(f, self.duration)
-        write_uint16(f, len(self.animations)*3) # Three times the matrix animations
-        count_offset = f.tell()
-        f.write(b"1+1=11")  # Placeholder for scale, rotation and translation count
-        data_offsets = f.tell()
-        f.write(b"--OnceUponATimeInALandFarAway---")
-        f.write(b"\x00"*(0x7C - f.tell()))
+                yield "        }\n"
 
-        write_uint32(f, self.unknown_address)
+        yield "    ]\n"
+        yield "}\n"
 
-        matrix_anim_start = f.tell()
-        f.write(b"\x00"*(0x36*len(self.animations)))
-        write_padding(f, multiple=4)
-
-        index_start = f.tell()
-        for i in range(len(self.animations)):
-            write_uint16(f, i)
-
-        write_padding(f, multiple=4)
-
-        stringtable = StringTable()
+    def dump(self, f, digits=None):
+        for chunk in self.iter_json_chunks(digits):
+            f.write(chunk)
 
+    # Extremes of all rotation values and tangents in degrees
+    def rotation_range(self):
+        low = high = 0.0
         for anim in self.animations:
-            stringtable.strings.append(anim.name)
-
-        stringtable_start = f.tell()
-        stringtable.write(f)
-
-        write_padding(f, multiple=4)
-
-        matindex_start = f.tell()
+            for axis in "UVW":
+                for comp in anim.rotation[axis]:
+                    low = min(low, comp.value, comp.tangentIn, comp.tangentOut)
+                    high = max(high, comp.value, comp.tangentIn, comp.tangentOut)
+        return low, high
+
+    # Smallest angle scale with which all rotations can be stored. This gives the
+    # finest steps and therefore the smallest quantization error. The game shifts
+    # the stored values left by the angle scale, so it can't be negative.
+    def fit_anglescale(self):
+        low, high = self.rotation_range()
+        if low == 0.0 and high == 0.0:
+            return max(0, self.anglescale)
+
+        for anglescale in range(0, MAX_ANGLESCALE+1):
+            rotscale = rotation_scale(anglescale)
+            if round(high/rotscale) <= 0x7FFF and round(low/rotscale) >= -0x8000:
+                return anglescale
+
+        raise RuntimeError("Rotations between {} and {} are too big to be stored".format(low, high))
+
+    # Quantization error of every rotation track in degrees, measured over values and tangents,
+    # when they are rounded like write_btk(precise_rotations=True) does.
+    # Returns (material name, texture index, track name, max error, mean error) per track.
+    def rotation_errors(self, anglescale=None):
+        if anglescale is None:
+            anglescale = self.anglescale
+        rotscale = rotation_scale(anglescale)
+
+        errors = []
         for anim in self.animations:
-            write_uint8(f, anim.matindex)
-
-        write_padding(f, multiple=4)
+            for axis in "UVW":
+                max_error = 0.0
+                total_error = 0.0
+                count = 0
+
+                for comp in anim.rotation[axis]:
+                    for val in (comp.value, comp.tangentIn, comp.tangentOut):
+                        stored = round(val/rotscale)
+                        error = abs(stored*rotscale - val)
+                        max_error = max(max_error, error)
+                        total_error += error
+                        count += 1
+
+                mean_error = total_error/count if count > 0 else 0.0
+                errors.append((anim.name, anim.matindex, "rotation_"+axis.lower(), max_error, mean_error))
+
+        return errors
+
+    # Lays out the scale, rotation and translation pools that write_btk writes.
+    # Tracks that already appear in a pool are not stored again, their offset points
+    # to the existing values instead.
+    # With keep_pools=True the pools of the btk this was read from are kept and
+    # only animations whose tracks were changed or which were added are laid out.
+    def _build_pools(self, rotscale, precise_rotations=False, keep_pools=False):
+        if keep_pools:
+            self._compact_pools()
+            all_scales, all_rotations, all_translations = (list(pool) for pool in self._pools)
+        else:
+            all_scales = []
+            all_rotations = []
+            all_translations = []
 
-        center_start = f.tell()
         for anim in self.animations:
-            for val in anim.center:
-                write_float(f, val)
-
-        write_padding(f, multiple=4)
-
+            if keep_pools and anim._key_table is not None:
+                continue
 
-        all_scales = []
-        all_rotations = []
-        all_translations = []
-        for anim in self.animations:
             for axis in "UVW":
                 # Set up offset for scale
                 if len(anim.scale[axis]) == 1:
@@ -423,16 +460,25 @@ class BTKAnim(object):
                 if len(anim.rotation[axis]) == 1:
                     comp = anim.rotation[axis][0]
                     #angle = ((comp.value+180) % 360) - 180
-                    sequence = [comp.value/rotscale]
+                    if precise_rotations:
+                        sequence = [quantize_rotation(comp.value, rotscale)]
+                    else:
+                        sequence = [comp.value/rotscale]
                     print("seq", sequence)
                 else:
                     sequence = []
                     for comp in anim.rotation[axis]:
                         #angle = ((comp.value+180) % 360) - 180
-                        sequence.append(comp.time)
-                        sequence.append(comp.value/rotscale)
-                        sequence.append(comp.tangentIn/rotscale)
-                        sequence.append(comp.tangentOut/rotscale)
+                        if precise_rotations:
+                            sequence.append(int(round(comp.time)))
+                            sequence.append(quantize_rotation(comp.value, rotscale))
+                            sequence.append(quantize_rotation(comp.tangentIn, rotscale))
+                            sequence.append(quantize_rotation(comp.tangentOut, rotscale))
+                        else:
+                            sequence.append(comp.time)
+                            sequence.append(comp.value/rotscale)
+                            sequence.append(comp.tangentIn/rotscale)
+                            sequence.append(comp.tangentOut/rotscale)
                     print("seq", sequence)
                 offset = find_sequence(all_rotations, sequence)
                 if offset == -1:
@@ -471,7 +517,122 @@ class BTKAnim(object):
                     all_translations.append(comp.tangentIn)
                     all_translations.append(comp.tangentOut)"""
 
-                
+        return all_scales, all_rotations, all_translations
+
+    # Drops the values from the pools of the btk this was read from that no remaining
+    # key table entry uses anymore, e.g. those of animations that were replaced, and
+    # moves the offsets in the key table entries accordingly.
+    def _compact_pools(self):
+        kept = [anim for anim in self.animations if anim._key_table is not None]
+        key_tables = [list(anim._key_table) for anim in kept]
+        pools = []
+
+        for kind_index, pool in enumerate(self._pools):
+            used = [False]*len(pool)
+            # Each axis has a count, offset and tangent type for scale, rotation and translation
+            entries = [axis*9 + kind_index*3 for axis in range(3)]
+
+            for key_table in key_tables:
+                for entry in entries:
+                    count, offset, tan_type = key_table[entry:entry+3]
+                    if count == 1:
+                        length = 1
+                    else:
+                        length = count*(3 if tan_type == 0 else 4)
+                    for i in range(offset, offset+length):
+                        used[i] = True
+
+            new_offsets = {}
+            new_pool = []
+            for i, val in enumerate(pool):
+                if used[i]:
+                    new_offsets[i] = len(new_pool)
+                    new_pool.append(val)
+            pools.append(new_pool)
+
+            for key_table in key_tables:
+                for entry in entries:
+                    # Tracks without keys don't use their offset
+                    key_table[entry+1] = new_offsets.get(key_table[entry+1], 0)
+
+        for anim, key_table in zip(kept, key_tables):
+            anim._key_table = tuple(key_table)
+        self._pools = tuple(pools)
+
+    # With precise_rotations=True the angle scale is chosen by fit_anglescale and
+    # rotations are rounded instead of truncated. Otherwise the angle scale of the
+    # animation is used as is.
+    # With keep_pools=True the key data of a btk read with from_btk is reused for
+    # unchanged animations, see _build_pools. The angle scale is then never changed
+    # because the stored rotations depend on it.
+    def write_btk(self, f, precise_rotations=False, keep_pools=False):
+        keep_pools = keep_pools and self._pools is not None
+
+        if precise_rotations and not keep_pools:
+            anglescale = self.fit_anglescale()
+        else:
+            anglescale = self.anglescale
+        rotscale = rotation_scale(anglescale)
+
+        f.write(BTKFILEMAGIC)
+        filesize_offset = f.tell()
+        f.write(b"ABCD") # Placeholder for file size
+        write_uint32(f, 1) # Always a section count of 1
+        f.write(b"SVR1" + b"\xFF"*12)
+
+        ttk1_start = f.tell()
+        f.write(b"TTK1")
+
+        ttk1_size_offset = f.tell()
+        f.write(b"EFGH")  # Placeholder for ttk1 size
+        write_uint8(f, self.loop_mode)
+        write_sint8(f, anglescale)
+        
+        write_uint16(f, self.duration)
+        write_uint16(f, len(self.animations)*3) # Three times the matrix animations
+        count_offset = f.tell()
+        f.write(b"1+1=11")  # Placeholder for scale, rotation and translation count
+        data_offsets = f.tell()
+        f.write(b"--OnceUponATimeInALandFarAway---")
+        f.write(b"\x00"*(0x7C - f.tell()))
+
+        write_uint32(f, self.unknown_address)
+
+        matrix_anim_start = f.tell()
+        f.write(b"\x00"*(0x36*len(self.animations)))
+        write_padding(f, multiple=4)
+
+        index_start = f.tell()
+        for i in range(len(self.animations)):
+            write_uint16(f, i)
+
+        write_padding(f, multiple=4)
+
+        stringtable = StringTable()
+
+        for anim in self.animations:
+            stringtable.strings.append(anim.name)
+
+        stringtable_start = f.tell()
+        stringtable.write(f)
+
+        write_padding(f, multiple=4)
+
+        matindex_start = f.tell()
+        for anim in self.animations:
+            write_uint8(f, anim.matindex)
+
+        write_padding(f, multiple=4)
+
+        center_start = f.tell()
+        for anim in self.animations:
+            for val in anim.center:
+                write_float(f, val)
+
+        write_padding(f, multiple=4)
+
+
+        all_scales, all_rotations, all_translations = self._build_pools(rotscale, precise_rotations, keep_pools)
 
         scale_start = f.tell()
         for val in all_scales:
@@ -502,6 +663,10 @@ class BTKAnim(object):
 
         f.seek(matrix_anim_start)
         for anim in self.animations:
+            if keep_pools and anim._key_table is not None:
+                f.write(struct.pack(">"+"H"*27, *anim._key_table))
+                continue
+
             for axis in "UVW":
                 write_uint16(f, len(anim.scale[axis])) # Scale count for this animation
                 write_uint16(f, anim._scale_offsets[axis]) # Offset into scales
@@ -540,47 +705,26 @@ class BTKAnim(object):
         write_uint32(f, translations_start  - ttk1_start)
 
     @classmethod
-    def from_json(cls, f):
-        btkanimdata = json.load(f)
-
+    def from_dict(cls, btkanimdata, material_filter=None):
         btk = cls(
             btkanimdata["loop_mode"], btkanimdata["angle_scale"],
             btkanimdata["duration"], unknown_address=int(btkanimdata["unknown"], 16)
         )
 
-        for i, animation in enumerate(btkanimdata["animations"]):
-            matanim = MatrixAnimation(
-                i, 
-                animation["material_texture_index"], 
-                animation["material_name"], 
-                animation["center"])
-
-            for scale in animation["scale_u"]:
-                matanim.add_scale("U", AnimComponent(*scale))
-            for scale in animation["scale_v"]:
-                matanim.add_scale("V", AnimComponent(*scale))
-            for scale in animation["scale_w"]:
-                matanim.add_scale("W", AnimComponent(*scale))
-                
-            for rotation in animation["rotation_u"]:
-                matanim.add_rotation("U",  AnimComponent(*rotation))
-            for rotation in animation["rotation_v"]:
-                matanim.add_rotation("V",  AnimComponent(*rotation))
-            for rotation in animation["rotation_w"]:
-                matanim.add_rotation("W",  AnimComponent(*rotation))
-            
-            for translation in animation["translation_u"]:
-                matanim.add_translation("U", AnimComponent(*translation))
-            for translation in animation["translation_v"]:
-                matanim.add_translation("V", AnimComponent(*translation))
-            for translation in animation["translation_w"]:
-                matanim.add_translation("W", AnimComponent(*translation))
-            btk.animations.append(matanim)
+        for animation in btkanimdata["animations"]:
+            if material_filter is not None and not material_filter(animation["material_name"]):
+                continue
+            btk.animations.append(MatrixAnimation.from_dict(len(btk.animations), animation))
 
         return btk
 
     @classmethod
-    def from_btk(cls, f):
+    def from_json(cls, f, material_filter=None):
+        import json
+        return cls.from_dict(json.load(f), material_filter=material_filter)
+
+    @classmethod
+    def from_btk(cls, f, material_filter=None):
         header = f.read(8)
         if header != BTKFILEMAGIC:
             raise RuntimeError("Invalid header. Expected {} but found {}".format(BTKFILEMAGIC, header))
@@ -599,7 +743,7 @@ class BTKAnim(object):
 
         loop_mode = read_uint8(f)
         angle_scale = read_sint8(f) 
-        rotscale = (2.0**angle_scale) * (180.0 / 32768.0);
+        rotscale = rotation_scale(angle_scale)
         duration = read_uint16(f)
         btk = cls(loop_mode, angle_scale, duration)
 
@@ -685,6 +829,9 @@ class BTKAnim(object):
             center = struct.unpack(">fff", f.read(12))
             
             name = stringtable.strings[i]
+            if material_filter is not None and not material_filter(name):
+                continue
+
             print("================")
             print("anim", i)
             print("mat index", mat_index, "name", name, "center", center)
@@ -725,24 +872,809 @@ class BTKAnim(object):
             print(v_scale, v_rot, v_trans)
             
             print(w_scale, w_rot, w_trans)
+            matrix_animation._key_table = values
             btk.animations.append(matrix_animation)
-            
+
+        btk._pools = (scales, rotations, translations)
         return btk
-    
+
+
+# Structural diff and three-way merge of BTK animations.
+# Matrix animations are matched up by material name and texture index and
+# compared field by field (center and the nine tracks). Values are compared with
+# a tolerance so that float formatting differences between json files don't
+# show up as changes. Rotation tracks use at least one rotation step as tolerance.
+DEFAULT_TOLERANCE = 1e-4
+ANIM_FIELDS = ("center",) + TRACK_NAMES
+HEADER_FIELDS = (("loop_mode", "loop_mode"), ("angle_scale", "anglescale"),
+                 ("duration", "duration"), ("unknown", "unknown_address"))
+
+
+# Key for every animation of a btk. Animations that share material name and
+# texture index are told apart by the order in which they appear.
+def anim_keys(btk):
+    seen = {}
+    keys = []
+
+    for anim in btk.animations:
+        occurrence = seen.get((anim.name, anim.matindex), 0)
+        seen[(anim.name, anim.matindex)] = occurrence + 1
+        keys.append((anim.name, anim.matindex, occurrence))
+
+    return keys
+
+def field_values(anim, field):
+    if field == "center":
+        return list(anim.center)
+    else:
+        values = []
+        for comp in anim.get_track(field):
+            values.extend(comp.serialize())
+        return values
+
+# Values are snapped to a grid the size of the tolerance before hashing, so two
+# fields with the same hash are equal within the tolerance. Values that lie close
+# to a grid line can still hash differently, values_equal catches those.
+def values_hash(values, tolerance):
+    if tolerance == 0:
+        return hash((len(values), tuple(values)))
+    else:
+        return hash((len(values), tuple(round(x/tolerance) for x in values)))
+
+def values_equal(values_a, values_b, tolerance):
+    if len(values_a) != len(values_b):
+        return False
+
+    for a, b in zip(values_a, values_b):
+        if abs(a - b) > tolerance:
+            return False
+
+    return True
+
+def header_values(btk):
+    return [getattr(btk, attr) for name, attr in HEADER_FIELDS]
+
+
+class AnimIndex(object):
+    def __init__(self, btk, tolerance=DEFAULT_TOLERANCE):
+        self.btk = btk
+        self.tolerance = tolerance
+        self.anims = OrderedDict()
+        self.hashes = {}
+
+        for key, anim in zip(anim_keys(btk), btk.animations):
+            self.anims[key] = anim
+            self.hashes[key] = tuple(values_hash(field_values(anim, field), tolerance)
+                                     for field in ANIM_FIELDS)
+
+    # Rotations are stored in steps of rotation_scale(anglescale) degrees and truncated
+    # to them, so rotation tracks may differ by up to one step after a btk round trip.
+    def field_tolerance(self, other, field):
+        if field.startswith("rotation"):
+            anglescale = max(self.btk.anglescale, other.btk.anglescale)
+            return max(self.tolerance, rotation_scale(anglescale))
+        else:
+            return self.tolerance
+
+    def same_field(self, key, other, other_key, i):
+        if self.hashes[key][i] == other.hashes[other_key][i]:
+            return True
+
+        field = ANIM_FIELDS[i]
+        return values_equal(field_values(self.anims[key], field),
+                            field_values(other.anims[other_key], field),
+                            self.field_tolerance(other, field))
+
+    def same_anim(self, key, other, other_key):
+        # Unchanged animations are skipped by comparing the hashes only.
+        if self.hashes[key] == other.hashes[other_key]:
+            return True
+
+        for i in range(len(ANIM_FIELDS)):
+            if not self.same_field(key, other, other_key, i):
+                return False
+        return True
+
+    def changed_fields(self, key, other, other_key):
+        return [i for i in range(len(ANIM_FIELDS)) if not self.same_field(key, other, other_key, i)]
+
+
+def serialize_field(anim, field):
+    if field == "center":
+        return list(anim.center)
+    else:
+        return [comp.serialize() for comp in anim.get_track(field)]
+
+def serialize_header(btk):
+    header = OrderedDict()
+    for (name, attr), val in zip(HEADER_FIELDS, header_values(btk)):
+        if name == "unknown":
+            val = "0x{:x}".format(val)
+        header[name] = val
+    return header
+
+def deserialize_header_field(name, val):
+    if name == "unknown":
+        return int(val, 16)
+    else:
+        return val
+
+
+# Creates a patch that turns base into other. The patch is a json-compatible dict
+# and only contains the header fields, centers and tracks that were changed.
+def diff_btk(base, other, tolerance=DEFAULT_TOLERANCE):
+    base_index = AnimIndex(base, tolerance)
+    other_index = AnimIndex(other, tolerance)
+
+    patch = OrderedDict()
+    patch["header"] = OrderedDict()
+    patch["removed"] = []
+    patch["changed"] = []
+    patch["added"] = []
+
+    other_header = serialize_header(other)
+    for (name, attr), base_val, other_val in zip(HEADER_FIELDS, header_values(base), header_values(other)):
+        if base_val != other_val:
+            patch["header"][name] = other_header[name]
+
+    for key in base_index.anims:
+        if key not in other_index.anims:
+            patch["removed"].append(list(key))
+        elif not base_index.same_anim(key, other_index, key):
+            change = OrderedDict()
+            change["key"] = list(key)
+            for i in base_index.changed_fields(key, other_index, key):
+                field = ANIM_FIELDS[i]
+                change[field] = serialize_field(other_index.anims[key], field)
+            patch["changed"].append(change)
+
+    for key, anim in other_index.anims.items():
+        if key not in base_index.anims:
+            patch["added"].append(anim.serialize())
+
+    return patch
+
+def patch_is_empty(patch):
+    return not (patch["header"] or patch["removed"] or patch["changed"] or patch["added"])
+
+# Applies a patch created by diff_btk to btk in place.
+def apply_patch(btk, patch):
+    anims = OrderedDict(zip(anim_keys(btk), btk.animations))
+
+    for name, attr in HEADER_FIELDS:
+        if name in patch["header"]:
+            setattr(btk, attr, deserialize_header_field(name, patch["header"][name]))
+
+    for change in patch["changed"]:
+        key = tuple(change["key"])
+        if key not in anims:
+            raise RuntimeError("Cannot apply patch: no animation for material {} with texture index {}".format(
+                key[0], key[1]))
+
+        anim = anims[key]
+        for field in ANIM_FIELDS:
+            if field not in change:
+                continue
+            if field == "center":
+                anim.center = change[field]
+            else:
+                anim.set_track(field, [AnimComponent(*comp) for comp in change[field]])
+
+    for key in patch["removed"]:
+        key = tuple(key)
+        if key not in anims:
+            raise RuntimeError("Cannot apply patch: no animation for material {} with texture index {}".format(
+                key[0], key[1]))
+        del anims[key]
+
+    btk.animations = list(anims.values())
+    for animation in patch["added"]:
+        btk.animations.append(MatrixAnimation.from_dict(len(btk.animations), animation))
+
+    return btk
+
+
+# Replaces the animations of btk with the animations of other that have the same
+# material name and texture index. Animations of other that btk doesn't have are added.
+# Only animations are spliced, the header of btk is kept.
+# The replaced animations don't keep their key table entry, so when btk was read
+# from a btk file and is written with keep_pools=True, only they are laid out again.
+def splice_btk(btk, other):
+    anims = OrderedDict(zip(anim_keys(btk), btk.animations))
+
+    for key, anim in zip(anim_keys(other), other.animations):
+        anims[key] = anim
+
+    btk.animations = list(anims.values())
+    for i, anim in enumerate(btk.animations):
+        anim._index = i
+
+    return btk
+
+
+# Three-way merge of two btks that were both derived from base. Changes are merged
+# per header field, center and track. If both sides changed the same thing differently,
+# our version is kept and the conflict is reported. Returns the merged btk and a
+# list of conflict descriptions.
+def merge_btk(base, ours, theirs, tolerance=DEFAULT_TOLERANCE):
+    base_index = AnimIndex(base, tolerance)
+    ours_index = AnimIndex(ours, tolerance)
+    theirs_index = AnimIndex(theirs, tolerance)
+    conflicts = []
+
+    merged = BTKAnim(ours.loop_mode, ours.anglescale, ours.duration, ours.unknown_address)
+
+    for (name, attr), base_val, ours_val, theirs_val in zip(
+            HEADER_FIELDS, header_values(base), header_values(ours), header_values(theirs)):
+        if ours_val == base_val:
+            setattr(merged, attr, theirs_val)
+        elif theirs_val != base_val and theirs_val != ours_val:
+            conflicts.append("{}: changed to {} in ours and to {} in theirs".format(name, ours_val, theirs_val))
+
+    keys = list(ours_index.anims.keys())
+    keys.extend(key for key in theirs_index.anims if key not in ours_index.anims)
+
+    for key in keys:
+        desc = "material {} (texture index {})".format(key[0], key[1])
+        in_base = key in base_index.anims
+        in_ours = key in ours_index.anims
+        in_theirs = key in theirs_index.anims
+
+        if in_ours and in_theirs:
+            if ours_index.same_anim(key, theirs_index, key):
+                data = ours_index.anims[key].serialize()
+            elif not in_base:
+                conflicts.append("{}: added differently in ours and theirs".format(desc))
+                data = ours_index.anims[key].serialize()
+            else:
+                data = ours_index.anims[key].serialize()
+                theirs_changes = base_index.changed_fields(key, theirs_index, key)
+                ours_changes = base_index.changed_fields(key, ours_index, key)
+
+                for i in theirs_changes:
+                    field = ANIM_FIELDS[i]
+                    if i not in ours_changes:
+                        data[field] = serialize_field(theirs_index.anims[key], field)
+                    elif not ours_index.same_field(key, theirs_index, key, i):
+                        conflicts.append("{}: {} changed differently in ours and theirs".format(desc, field))
+        elif in_ours:
+            # Removed in theirs, or added in ours
+            if not in_base:
+                data = ours_index.anims[key].serialize()
+            elif base_index.same_anim(key, ours_index, key):
+                continue
+            else:
+                conflicts.append("{}: removed in theirs but changed in ours".format(desc))
+                data = ours_index.anims[key].serialize()
+        else:
+            # Removed in ours, or added in theirs
+            if not in_base:
+                data = theirs_index.anims[key].serialize()
+            elif base_index.same_anim(key, theirs_index, key):
+                continue
+            else:
+                conflicts.append("{}: removed in ours but changed in theirs".format(desc))
+                continue
+
+        merged.animations.append(MatrixAnimation.from_dict(len(merged.animations), data))
+
+    return merged, conflicts
+
+
+# Analysis of a set of btks, e.g. all btks of a stage. Tracks are indexed by their
+# content so that tracks which repeat within a file or across files can be found.
+# Tracks of the same kind share a pool in a btk, so e.g. rotation_u and rotation_w
+# with the same keys count as the same track.
+POOL_VALUE_SIZE = {"scale": 4, "rotation": 2, "translation": 4}
+
+# The pool data write_btk stores for a track: float32 values for scale and translation,
+# truncated sint16 steps for rotation. A track with a single key only stores its value.
+def stored_track(anim, trackname, anglescale):
+    kind = trackname.split("_")[0]
+    comps = anim.get_track(trackname)
+
+    if len(comps) == 1:
+        values = [comps[0].value]
+    else:
+        values = field_values(anim, trackname)
+
+    if kind == "rotation":
+        rotscale = rotation_scale(anglescale)
+        stored = []
+        for i, val in enumerate(values):
+            if len(comps) > 1 and i % 4 == 0:
+                stored.append(int(val))  # Key time
+            else:
+                stored.append(int(val/rotscale))
+        return struct.pack(">"+"h"*len(stored), *stored)
+    else:
+        return struct.pack(">"+"f"*len(values), *values)
+
+# Tracks are keyed on their stored data, so a track read from a btk matches the
+# same track read from json. Rotation steps depend on the angle scale, so rotation
+# tracks of btks with different angle scales never match.
+def track_content_key(anim, trackname, anglescale):
+    kind = trackname.split("_")[0]
+    data = stored_track(anim, trackname, anglescale)
+    if kind != "rotation":
+        anglescale = None
+    return kind, anglescale, data
+
+# Number of pool values write_btk uses for a track
+def pool_length(content_key):
+    kind, anglescale, data = content_key
+    return len(data)//POOL_VALUE_SIZE[kind]
+
+
+class BTKLibrary(object):
+    def __init__(self):
+        self.files = OrderedDict()
+        self.tracks = OrderedDict()
+        # Keys of the first track found for each content key
+        self.track_keys = {}
+
+    @classmethod
+    def from_paths(cls, paths):
+        library = cls()
+        for path in paths:
+            library.add(path, load_anim(path))
+        return library
+
+    def add(self, name, btk):
+        self.files[name] = btk
+
+        for anim in btk.animations:
+            for trackname in TRACK_NAMES:
+                key = track_content_key(anim, trackname, btk.anglescale)
+                if key not in self.tracks:
+                    self.tracks[key] = []
+                    self.track_keys[key] = [comp.serialize() for comp in anim.get_track(trackname)]
+                self.tracks[key].append((name, anim.name, anim.matindex, trackname))
+
+    def files_using(self, key):
+        return set(use[0] for use in self.tracks[key])
+
+    def stats(self):
+        stats = OrderedDict()
+        stats["files"] = len(self.files)
+        stats["animations"] = sum(len(btk.animations) for btk in self.files.values())
+        stats["tracks"] = sum(len(uses) for uses in self.tracks.values())
+        stats["unique_tracks"] = len(self.tracks)
+
+        animated = [key for key in self.tracks if pool_length(key) > 1]
+        stats["animated_tracks"] = sum(len(self.tracks[key]) for key in animated)
+        stats["unique_animated_tracks"] = len(animated)
+        stats["animated_tracks_in_several_files"] = sum(1 for key in animated if len(self.files_using(key)) > 1)
+
+        # Size of the key pools as written by write_btk, compared to storing every
+        # distinct track only once for all files together.
+        pool_bytes = 0
+        for btk in self.files.values():
+            rotscale = rotation_scale(btk.anglescale)
+            for kind, pool in zip(("scale", "rotation", "translation"), btk._build_pools(rotscale)):
+                pool_bytes += len(pool)*POOL_VALUE_SIZE[kind]
+        stats["pool_bytes"] = pool_bytes
+        stats["shared_pool_bytes"] = sum(pool_length(key)*POOL_VALUE_SIZE[key[0]] for key in self.tracks)
+
+        return stats
+
+    # Animated tracks that are used by at least min_files files, most used first.
+    def shared_tracks(self, min_files=2):
+        templates = []
+
+        for key, uses in self.tracks.items():
+            if pool_length(key) > 1 and len(self.files_using(key)) >= min_files:
+                kind, anglescale, data = key
+                template = OrderedDict()
+                template["kind"] = kind
+                if anglescale is not None:
+                    template["angle_scale"] = anglescale
+                template["keys"] = self.track_keys[key]
+                template["uses"] = [OrderedDict((("file", path), ("material_name", name),
+                                                 ("material_texture_index", matindex), ("track", trackname)))
+                                    for path, name, matindex, trackname in uses]
+                templates.append(template)
+
+        templates.sort(key=lambda template: len(template["uses"]), reverse=True)
+        return templates
+
+    # Checks that write_btk stores every distinct track of a file only once.
+    # Returns (file, kind, pool length, length with every distinct track stored once)
+    # for every pool that is bigger than necessary.
+    def check_sharing(self):
+        problems = []
+
+        for path, btk in self.files.items():
+            distinct = {"scale": set(), "rotation": set(), "translation": set()}
+            for anim in btk.animations:
+                for trackname in TRACK_NAMES:
+                    key = track_content_key(anim, trackname, btk.anglescale)
+                    distinct[key[0]].add(key)
+
+            pools = btk._build_pools(rotation_scale(btk.anglescale))
+            for kind, pool in zip(("scale", "rotation", "translation"), pools):
+                needed = sum(pool_length(key) for key in distinct[kind])
+                if len(pool) > needed:
+                    problems.append((path, kind, len(pool), needed))
+
+        return problems
+
+
+def encoding_from_bom(bom):
+    if bom.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+    elif bom.startswith(codecs.BOM_UTF32_LE) or bom.startswith(codecs.BOM_UTF32_BE):
+        encoding = "utf-32"
+    elif bom.startswith(codecs.BOM_UTF16_LE) or bom.startswith(codecs.BOM_UTF16_BE):
+        encoding = "utf-16"
+    else:
+        encoding = "utf-8"
+
+    return encoding
+
+def detect_encoding(path):
+    # Detect BOM of input file
+    with open(path, "rb") as f:
+        bom = f.read(4)
+
+    return encoding_from_bom(bom)
+
+def is_btk_file(path):
+    with open(path, "rb") as f:
+        return f.read(8) == BTKFILEMAGIC
+
+def load_json_file(path):
+    import json
+    encoding = detect_encoding(path)
+    print("Assuming encoding of input file:", encoding)
+
+    with open(path, "r", encoding=encoding) as f:
+        return json.load(f)
+
+# Returns a function that tells whether a material name is selected by the
+# only and exclude lists of patterns, or None if nothing is filtered.
+def make_material_filter(only=None, exclude=None):
+    if only is None and exclude is None:
+        return None
+
+    import fnmatch
+
+    def material_filter(name):
+        if only is not None and not any(fnmatch.fnmatchcase(name, pattern) for pattern in only):
+            return False
+        if exclude is not None and any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude):
+            return False
+        return True
+
+    return material_filter
+
+# Loads either a btk or a json file
+def load_anim(path, material_filter=None):
+    if is_btk_file(path):
+        with open(path, "rb") as f:
+            return BTKAnim.from_btk(f, material_filter=material_filter)
+    else:
+        return BTKAnim.from_dict(load_json_file(path), material_filter=material_filter)
+
+# Angle scale that write_btk(precise_rotations=True) uses and the resulting error
+# of every rotation track that isn't stored exactly.
+def rotation_report(btk):
+    anglescale = btk.fit_anglescale()
+    errors = [error for error in btk.rotation_errors(anglescale) if error[3] > 0.0]
+    return anglescale, errors
+
+def print_rotation_report(btk):
+    anglescale, errors = rotation_report(btk)
+    print("Angle scale: {} (was {})".format(anglescale, btk.anglescale))
+
+    for name, matindex, trackname, max_error, mean_error in errors:
+        print("{} (texture index {}) {}: max error {:.6f}, mean error {:.6f} degrees".format(
+            name, matindex, trackname, max_error, mean_error))
+
+# A path of "-" writes to stdout, or to the given stdout replacement.
+def save_anim(btk, path, as_btk, digits=None, stdout=None, precise_rotations=False, keep_pools=False):
+    if as_btk and precise_rotations:
+        print_rotation_report(btk)
+
+    if path == "-":
+        if stdout is None:
+            stdout = sys.stdout
+
+        if as_btk:
+            # write_btk needs to seek back to fill in offsets, which pipes can't do
+            data = io.BytesIO()
+            btk.write_btk(data, precise_rotations=precise_rotations, keep_pools=keep_pools)
+            stdout.flush()
+            stdout.buffer.write(data.getvalue())
+            stdout.buffer.flush()
+        else:
+            btk.dump(stdout, digits=digits)
+            stdout.flush()
+    elif as_btk:
+        with open(path, "wb") as f:
+            btk.write_btk(f, precise_rotations=precise_rotations, keep_pools=keep_pools)
+    else:
+        with open(path, "w") as f:
+            btk.dump(f, digits=digits)
+
+def suffixed_path(path, suffix):
+    root, ext = os.path.splitext(path)
+    return root + suffix + ext
+
+
+# Converts btk data to json text or json data to btk data, depending on
+# what the input is. Returns the converted data, whether it is a btk and, when
+# writing a btk with precise_rotations, the result of rotation_report.
+def convert_data(data, digits=None, precise_rotations=False, material_filter=None):
+    if data[:8] == BTKFILEMAGIC:
+        btk = BTKAnim.from_btk(io.BytesIO(data), material_filter=material_filter)
+        out = io.StringIO()
+        btk.dump(out, digits=digits)
+        return out.getvalue().encode("utf-8"), False, None
+    else:
+        text = data.decode(encoding_from_bom(data[:4]))
+        btk = BTKAnim.from_json(io.StringIO(text), material_filter=material_filter)
+        report = rotation_report(btk) if precise_rotations else None
+        out = io.BytesIO()
+        btk.write_btk(out, precise_rotations=precise_rotations)
+        return out.getvalue(), True, report
+
+
+# Conversion server. Requests and responses are json objects, one per line.
+# A request looks like
+#   {"id": 1, "input": "path/to/file.btk", "output": "path/to/file.json", "ndigits": 6}
+# where instead of "input" the file content can be passed base64-encoded as "input_data".
+# If "output" is left out the converted data is returned base64-encoded as "output_data".
+# Responses carry the id of their request and are sent in the order in which
+# the conversions finish, not in the order of the requests.
+def handle_request(request):
+    import base64
+    import contextlib
+
+    response = {"id": request.get("id")}
+    log = io.StringIO()
+
+    try:
+        # Conversions print progress information which would otherwise end up in
+        # the response stream.
+        with contextlib.redirect_stdout(log):
+            if "input_data" in request:
+                data = base64.b64decode(request["input_data"])
+            else:
+                with open(request["input"], "rb") as f:
+                    data = f.read()
+
+            # Like --ndigits, a negative value means no rounding
+            ndigits = request.get("ndigits")
+            if ndigits is not None and ndigits < 0:
+                ndigits = None
+
+            material_filter = make_material_filter(request.get("only"), request.get("exclude"))
+            out, out_is_btk, report = convert_data(data, digits=ndigits,
+                                                   precise_rotations=request.get("precise_rotations", False),
+                                                   material_filter=material_filter)
+
+            if request.get("output") is not None:
+                with open(request["output"], "wb") as f:
+                    f.write(out)
+                response["output"] = request["output"]
+            else:
+                response["output_data"] = base64.b64encode(out).decode("ascii")
+
+        response["ok"] = True
+        response["format"] = "btk" if out_is_btk else "json"
+        if report is not None:
+            anglescale, errors = report
+            response["angle_scale"] = anglescale
+            response["rotation_errors"] = [
+                {"material_name": name, "material_texture_index": matindex, "track": trackname,
+                 "max_error": max_error, "mean_error": mean_error}
+                for name, matindex, trackname, max_error, mean_error in errors]
+    except Exception as err:
+        response["ok"] = False
+        response["error"] = "{}: {}".format(type(err).__name__, err)
+
+    if request.get("log"):
+        response["log"] = log.getvalue()
+
+    return response
+
+def handle_request_line(line):
+    import json
+
+    try:
+        request = json.loads(line)
+    except ValueError as err:
+        return {"id": None, "ok": False, "error": "Invalid request: {}".format(err)}
+
+    return handle_request(request)
+
+# Id of a request line, for error responses that can't come from handle_request
+def request_line_id(line):
+    import json
+
+    try:
+        return json.loads(line).get("id")
+    except (ValueError, AttributeError):
+        return None
+
+# Process pool that replaces itself with a new one when a worker process died,
+# which leaves a ProcessPoolExecutor unable to run anything.
+class WorkerPool(object):
+    def __init__(self, workers=None):
+        import threading
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(self, fn, *args):
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+
+        with self.lock:
+            executor = self.executor
+
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    print("A worker process died, restarting the worker pool", file=sys.stderr)
+                    executor.shutdown(wait=False)
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                executor = self.executor
+
+            # The request had nothing to do with the crash, so run it on the new pool
+            return executor.submit(fn, *args)
+
+    def shutdown(self):
+        with self.lock:
+            self.executor.shutdown(wait=True)
+
+# Reads requests from infile and writes the responses to outfile while the
+# conversions are run by a pool of worker processes.
+def serve_stream(infile, outfile, pool):
+    import json
+    import threading
+
+    lock = threading.Lock()
+    # Number of requests whose response hasn't been written yet
+    pending = [0]
+    all_sent = threading.Condition(lock)
+
+    def send(response):
+        with lock:
+            outfile.write(json.dumps(response) + "\n")
+            outfile.flush()
+
+    def error_response(line, err):
+        return {"id": request_line_id(line), "ok": False, "error": "{}: {}".format(type(err).__name__, err)}
+
+    def send_result(future, line):
+        try:
+            response = future.result()
+        except Exception as err:
+            response = error_response(line, err)
+
+        send(response)
+        with all_sent:
+            pending[0] -= 1
+            all_sent.notify_all()
+
+    for line in infile:
+        if not line.strip():
+            continue
+
+        try:
+            future = pool.submit(handle_request_line, line)
+        except Exception as err:
+            send(error_response(line, err))
+            continue
+
+        with all_sent:
+            pending[0] += 1
+        future.add_done_callback(lambda future, line=line: send_result(future, line))
+
+    # Wait until all responses are written
+    with all_sent:
+        while pending[0] > 0:
+            all_sent.wait()
+
+def serve(socket_path=None, workers=None):
+    pool = WorkerPool(workers)
+
+    try:
+        if socket_path is None:
+            serve_stream(sys.stdin, sys.stdout, pool)
+        else:
+            import socketserver
+
+            class ConversionHandler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    infile = io.TextIOWrapper(self.rfile, encoding="utf-8")
+                    outfile = io.TextIOWrapper(self.wfile, encoding="utf-8")
+                    serve_stream(infile, outfile, pool)
+
+            # Remove a socket left over from an earlier run, but never other files
+            if os.path.exists(socket_path):
+                import stat
+                if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                    raise RuntimeError("{} exists and is not a socket".format(socket_path))
+                os.remove(socket_path)
+
+            server = socketserver.ThreadingUnixStreamServer(socket_path, ConversionHandler)
+            print("Listening on", socket_path, file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                os.remove(socket_path)
+    finally:
+        pool.shutdown()
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("input",
+    parser.add_argument("input", nargs="?",
                         help="Path to btk or json-formatted text file.")
     parser.add_argument("--ndigits", default=-1, type=int,
                         help="The amount of digits after the decimal point to which values should be rounded "
                              "when converting btk to json. -1 for no rounding.")
+    parser.add_argument("--precise-rotations", action="store_true",
+                        help="When writing a btk, ignore the angle scale from the json file and use the smallest "
+                             "angle scale (0 or bigger) that fits all rotations, and round rotations instead of "
+                             "truncating them. "
+                             "Prints the resulting quantization error of each rotation track.")
+    parser.add_argument("--only", default=None, nargs="+", metavar="MATERIAL",
+                        help="When converting, only write the animations of these materials. "
+                             "Wildcards like * and ? can be used.")
+    parser.add_argument("--exclude", default=None, nargs="+", metavar="MATERIAL",
+                        help="When converting, leave out the animations of these materials. "
+                             "Wildcards like * and ? can be used.")
+    parser.add_argument("--splice", default=None, metavar="JSON",
+                        help="Replace the animations in the btk input with the animations from JSON that have the "
+                             "same material name and texture index, and add the others. The key data of the "
+                             "untouched animations and the header of the btk are kept as is. "
+                             "Output defaults to <input>.spliced.")
+    parser.add_argument("--diff", default=None, metavar="OTHER",
+                        help="Compare input against OTHER (btk or json) and write the differences as a "
+                             "json patch to output. Output defaults to <input>.patch.json.")
+    parser.add_argument("--patch", default=None, metavar="PATCH",
+                        help="Apply a patch created with --diff to input. The result is written in the "
+                             "same format as input. Output defaults to <input>.patched.")
+    parser.add_argument("--merge", default=None, nargs=2, metavar=("BASE", "THEIRS"),
+                        help="Three-way merge of input and THEIRS, which were both derived from BASE. "
+                             "On conflicts the version from input is kept. The result is written in the "
+                             "same format as input. Output defaults to <input>.merged.")
+    parser.add_argument("--tolerance", default=DEFAULT_TOLERANCE, type=float,
+                        help="Values that differ by at most this amount are considered equal "
+                             "by --diff and --merge. Rotations always get at least one rotation step "
+                             "of the angle scale as tolerance.")
+    parser.add_argument("--server", action="store_true",
+                        help="Run as a conversion server that reads json requests from stdin, one per line, "
+                             "and writes the responses to stdout. Input and output are not used.")
+    parser.add_argument("--socket", default=None, metavar="PATH",
+                        help="With --server, listen on a Unix socket at PATH instead of using stdin and stdout.")
+    parser.add_argument("--workers", default=None, type=int,
+                        help="Number of worker processes used by --server. Defaults to the number of CPUs.")
+    parser.add_argument("--library", default=None, nargs="+", metavar="FILE",
+                        help="Analyse a set of btk or json files, e.g. all btks of a stage, and report how many "
+                             "tracks are shared within and across the files. Input and output are not used.")
+    parser.add_argument("--templates", default=None, metavar="PATH",
+                        help="With --library, write the animated tracks that are used by several files "
+                             "to PATH as json.")
     parser.add_argument("output", default=None, nargs = '?',
                         help=(
                             "Path to which the converted file should be written. "
                             "If input was a BTK, writes a json file. If input was a json file, writes a BTK."
-                            "If left out, output defaults to <input>.json or <input>.btk."
+                            "If left out, output defaults to <input>.json or <input>.btk. "
+                            "Use - to write to stdout."
                         ))
 
     args = parser.parse_args()
@@ -752,44 +1684,94 @@ if __name__ == "__main__":
     else:
         ndigits = args.ndigits
 
-
-    with open(args.input, "rb") as f:
-        if f.read(8) == BTKFILEMAGIC:
-            btk_to_json = True
-        else:
-            btk_to_json = False
-
-    if args.output is None:
-        if btk_to_json:
-            output = args.input+".json"
+    if args.server:
+        serve(socket_path=args.socket, workers=args.workers)
+        sys.exit(0)
+    elif args.library is not None:
+        import contextlib
+
+        # Loading and laying out the pools prints a lot, only keep the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            library = BTKLibrary.from_paths(args.library)
+            stats = library.stats()
+            problems = library.check_sharing()
+            templates = library.shared_tracks()
+
+        for name, val in stats.items():
+            print("{}: {}".format(name.replace("_", " "), val))
+        for path, kind, pool_size, needed in problems:
+            print("{}: {} pool has {} values, {} would be enough".format(path, kind, pool_size, needed))
+        print("{} animated tracks are used by several files".format(len(templates)))
+
+        if args.templates is not None:
+            import json
+            with open(args.templates, "w") as f:
+                json.dump(templates, f, indent=4)
+        sys.exit(0)
+    elif args.input is None:
+        parser.error("the following arguments are required: input")
+
+    # These options only apply to a plain conversion
+    for name, used in (("--diff", args.diff is not None), ("--patch", args.patch is not None),
+                       ("--merge", args.merge is not None), ("--splice", args.splice is not None)):
+        if used and (args.only is not None or args.exclude is not None):
+            parser.error("--only and --exclude can't be used with {}".format(name))
+    if args.splice is not None and args.precise_rotations:
+        parser.error("--precise-rotations can't be used with --splice, the angle scale of the btk is kept")
+
+    btk_input = is_btk_file(args.input)
+
+    # When writing to stdout, diagnostic messages go to stderr instead
+    # so that they don't end up in the converted data.
+    stdout = sys.stdout
+    if args.output == "-":
+        sys.stdout = sys.stderr
+
+    if args.diff is not None:
+        output = args.output if args.output is not None else args.input+".patch.json"
+        patch = diff_btk(load_anim(args.input), load_anim(args.diff), tolerance=args.tolerance)
+        import json
+        if patch_is_empty(patch):
+            print("No differences found.")
+        if output == "-":
+            json.dump(patch, stdout)
+            stdout.write("\n")
         else:
-            output = args.input+".btk"
-    else:
-        output = args.output
+            with open(output, "w") as f:
+                json.dump(patch, f)
+
+    elif args.patch is not None:
+        output = args.output if args.output is not None else suffixed_path(args.input, ".patched")
+        btk = apply_patch(load_anim(args.input), load_json_file(args.patch))
+        save_anim(btk, output, btk_input, digits=ndigits, stdout=stdout,
+                  precise_rotations=args.precise_rotations)
+
+    elif args.splice is not None:
+        if not btk_input:
+            parser.error("--splice needs a btk as input")
+        output = args.output if args.output is not None else suffixed_path(args.input, ".spliced")
+        btk = splice_btk(load_anim(args.input), load_anim(args.splice))
+        save_anim(btk, output, True, stdout=stdout, keep_pools=True)
+
+    elif args.merge is not None:
+        output = args.output if args.output is not None else suffixed_path(args.input, ".merged")
+        base_path, theirs_path = args.merge
+        btk, conflicts = merge_btk(load_anim(base_path), load_anim(args.input), load_anim(theirs_path),
+                                   tolerance=args.tolerance)
+        for conflict in conflicts:
+            print("Conflict:", conflict)
+        save_anim(btk, output, btk_input, digits=ndigits, stdout=stdout,
+                  precise_rotations=args.precise_rotations)
 
-    if btk_to_json:
-        with open(args.input, "rb") as f:
-            btk = BTKAnim.from_btk(f)
-        with open(output, "w") as f:
-            btk.dump(f, digits=ndigits)
     else:
-        # Detect BOM of input file
-        with open(args.input, "rb") as f:
-            bom = f.read(4)
-        
-        if bom.startswith(codecs.BOM_UTF8):
-            encoding = "utf-8-bom"
-        elif bom.startswith(codecs.BOM_UTF32_LE) or bom.startswith(codecs.BOM_UTF32_BE):
-            encoding = "utf-32"
-        elif bom.startswith(codecs.BOM_UTF16_LE) or bom.startswith(codecs.BOM_UTF16_BE):
-            encoding = "utf-16"
+        if args.output is None:
+            if btk_input:
+                output = args.input+".json"
+            else:
+                output = args.input+".btk"
         else:
-            encoding = "utf-8"
-        
-        print("Assuming encoding of input file:", encoding)
-        
-        with io.open(args.input, "r", encoding=encoding) as f:
-            #with open(args.input, "rb") as f:
-            btk = BTKAnim.from_json(f)
-        with open(output, "wb") as f:
-            btk.write_btk(f)
+            output = args.output
+
+        material_filter = make_material_filter(args.only, args.exclude)
+        save_anim(load_anim(args.input, material_filter), output, not btk_input, digits=ndigits, stdout=stdout,
+                  precise_rotations=args.precise_rotations)